@@ -1,16 +1,38 @@
 from __future__ import annotations
 
+import base64
+import http.client
 import ipaddress
 import json
+import re
 import socket
-from dataclasses import dataclass
-from urllib import request
-from urllib.error import URLError
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields, is_dataclass
+from urllib.parse import unquote, urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass_environment
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
 
 
 CYMRU_HOST = "whois.cymru.com"
 CYMRU_PORT = 43
-BGPVIEW_URL = "https://api.bgpview.io/ip/{ip}"
+BGPVIEW_HOST = "api.bgpview.io"
+BGPVIEW_PATH = "/ip/{ip}"
+CACHE_MAXSIZE = 100_000
+CACHE_TTL_SEC = 3600.0
+FALLBACK_MAX_WORKERS = 32
+RECV_BUFFER_SIZE = 2048
+MAX_REDIRECTS = 3
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+REQUEST_HEADERS = {"Accept": "application/json", "User-Agent": "ip-asn-lookup/1.0"}
+
+_FIELD_SEPARATOR = re.compile(r"\s*\|\s*")
 
 
 class InvalidIPError(ValueError):
@@ -21,7 +43,7 @@ class UpstreamLookupError(RuntimeError):
     pass
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ASNResult:
     ip: str
     asn: int
@@ -33,7 +55,164 @@ class ASNResult:
     source: str = "team-cymru-whois"
 
 
+class TTLCache:
+    def __init__(self, maxsize: int, ttl_sec: float) -> None:
+        self.maxsize = maxsize
+        self.ttl_sec = ttl_sec
+        self._entries: OrderedDict[str, tuple[float, ASNResult]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, now: float | None = None) -> ASNResult | None:
+        current = now if now is not None else time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= current:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: ASNResult, now: float | None = None) -> None:
+        if self.maxsize <= 0 or self.ttl_sec <= 0:
+            return
+
+        current = now if now is not None else time.monotonic()
+        with self._lock:
+            self._entries[key] = (current + self.ttl_sec, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_RESULT_CACHE = TTLCache(maxsize=CACHE_MAXSIZE, ttl_sec=CACHE_TTL_SEC)
+
+
+class KeepAlivePool:
+    def __init__(self, host: str, maxsize: int) -> None:
+        self.host = host
+        self.maxsize = maxsize
+        self._idle: list[http.client.HTTPSConnection] = []
+        self._lock = threading.Lock()
+
+    def get(self, path: str, timeout_sec: float) -> tuple[int, bytes]:
+        # Redirects are followed only while they stay on this pool's host.
+        for _ in range(MAX_REDIRECTS + 1):
+            status, location, body = self._get_once(path, timeout_sec)
+            if status not in REDIRECT_STATUSES or not location:
+                break
+            target = urlsplit(urljoin(f"https://{self.host}{path}", location))
+            if target.scheme != "https" or target.hostname != self.host:
+                break
+            path = f"{target.path}?{target.query}" if target.query else target.path
+        return status, body
+
+    def _get_once(self, path: str, timeout_sec: float) -> tuple[int, str | None, bytes]:
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+
+        if conn is not None:
+            try:
+                return self._send(conn, path, timeout_sec)
+            except TimeoutError:
+                raise
+            except (OSError, http.client.HTTPException):
+                # The server may have closed the idle connection; retry once.
+                pass
+
+        return self._send(self._connect(timeout_sec), path, timeout_sec)
+
+    def _connect(self, timeout_sec: float) -> http.client.HTTPSConnection:
+        # Honour HTTPS_PROXY/NO_PROXY the way urlopen does, tunnelling
+        # through the proxy with CONNECT.
+        proxies = getproxies()
+        proxy = proxies.get("https")
+        if not proxy or proxy_bypass_environment(self.host, proxies):
+            return http.client.HTTPSConnection(self.host, timeout=timeout_sec)
+
+        parsed = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+        headers: dict[str, str] = {}
+        if parsed.username:
+            credentials = f"{unquote(parsed.username)}:{unquote(parsed.password or '')}"
+            token = base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+            headers["Proxy-Authorization"] = f"Basic {token}"
+
+        conn = http.client.HTTPSConnection(parsed.hostname, parsed.port or 80, timeout=timeout_sec)
+        conn.set_tunnel(self.host, headers=headers)
+        return conn
+
+    def _send(
+        self, conn: http.client.HTTPSConnection, path: str, timeout_sec: float
+    ) -> tuple[int, str | None, bytes]:
+        conn.timeout = timeout_sec
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout_sec)
+
+        try:
+            conn.request("GET", path, headers=REQUEST_HEADERS)
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+
+        result = (response.status, response.getheader("Location"), body)
+        if not response.will_close:
+            with self._lock:
+                if len(self._idle) < self.maxsize:
+                    self._idle.append(conn)
+                    return result
+        conn.close()
+        return result
+
+    def clear(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_BGPVIEW_POOL = KeepAlivePool(BGPVIEW_HOST, maxsize=FALLBACK_MAX_WORKERS)
+_FALLBACK_POOL = ThreadPoolExecutor(
+    max_workers=FALLBACK_MAX_WORKERS, thread_name_prefix="asn-fallback"
+)
+
+
+def _json_loads(raw: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+
+def _json_default(obj: object) -> dict:
+    if is_dataclass(obj):
+        return {field.name: getattr(obj, field.name) for field in fields(obj)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_dumps(payload: object) -> bytes:
+    # orjson serializes dataclasses natively, so results are encoded
+    # straight from their fields without building intermediate dicts.
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=_json_default).encode("utf-8")
+
+
 def _validate_ip(ip: str) -> str:
+    # inet_pton only accepts canonical dotted-quad IPv4 text, so anything it
+    # parses is already normalized; everything else goes through ipaddress.
+    try:
+        socket.inet_pton(socket.AF_INET, ip)
+        return ip
+    except (OSError, TypeError, ValueError):
+        pass
+
     try:
         parsed = ipaddress.ip_address(ip)
     except ValueError as exc:
@@ -42,13 +221,12 @@ def _validate_ip(ip: str) -> str:
 
 
 def _parse_verbose_line(ip: str, line: str) -> ASNResult:
-    parts = [p.strip() for p in line.split("|")]
+    parts = _FIELD_SEPARATOR.split(line.strip(), 6)
     if len(parts) < 7:
         raise UpstreamLookupError("Unexpected upstream response format")
 
-    asn_text = parts[0].upper().replace("AS", "").strip()
     try:
-        asn = int(asn_text)
+        asn = int(parts[0].removeprefix("AS"))
     except ValueError as exc:
         raise UpstreamLookupError("Invalid ASN value from upstream") from exc
 
@@ -63,37 +241,70 @@ def _parse_verbose_line(ip: str, line: str) -> ASNResult:
     )
 
 
-def _lookup_team_cymru(normalized_ip: str, timeout_sec: float) -> ASNResult:
-    query = f" -v {normalized_ip}\n".encode("utf-8")
-
+def _query_team_cymru(query: bytes, timeout_sec: float) -> bytearray:
     try:
         with socket.create_connection((CYMRU_HOST, CYMRU_PORT), timeout=timeout_sec) as sock:
             sock.sendall(query)
             sock.shutdown(socket.SHUT_WR)
 
-            chunks: list[bytes] = []
+            buf = bytearray(RECV_BUFFER_SIZE)
+            size = 0
             while True:
-                data = sock.recv(4096)
-                if not data:
+                if size == len(buf):
+                    buf = buf + bytes(len(buf))
+                received = sock.recv_into(memoryview(buf)[size:])
+                if not received:
                     break
-                chunks.append(data)
+                size += received
     except OSError as exc:
         raise UpstreamLookupError("Unable to reach upstream ASN service") from exc
 
-    raw = b"".join(chunks).decode("utf-8", errors="replace")
-    lines = [line.strip() for line in raw.splitlines() if line.strip()]
+    return buf[:size]
+
+
+def _lookup_team_cymru(normalized_ip: str, timeout_sec: float) -> ASNResult:
+    raw = _query_team_cymru(f" -v {normalized_ip}\n".encode("utf-8"), timeout_sec)
+    lines = raw.strip().rsplit(b"\n", 1)
     if len(lines) < 2:
         raise UpstreamLookupError("No ASN data returned from upstream")
 
-    return _parse_verbose_line(normalized_ip, lines[-1])
+    return _parse_verbose_line(normalized_ip, lines[-1].decode("utf-8", errors="replace"))
+
+
+def _lookup_team_cymru_bulk(normalized_ips: list[str], timeout_sec: float) -> dict[str, ASNResult]:
+    # Lines are matched by their IP column; IPs without a usable line are
+    # omitted so the caller can fall back for them individually.
+    query = "begin\nverbose\n" + "\n".join(normalized_ips) + "\nend\n"
+    raw = _query_team_cymru(query.encode("utf-8"), timeout_sec).decode("utf-8", errors="replace")
+
+    wanted = set(normalized_ips)
+    results: dict[str, ASNResult] = {}
+    for line in raw.splitlines():
+        parts = line.split("|", 2)
+        if len(parts) < 3:
+            continue
+        ip = parts[1].strip()
+        if ip not in wanted:
+            continue
+        try:
+            results[ip] = _parse_verbose_line(ip, line)
+        except UpstreamLookupError:
+            continue
+    return results
 
 
 def _lookup_bgpview(normalized_ip: str, timeout_sec: float) -> ASNResult:
-    url = BGPVIEW_URL.format(ip=normalized_ip)
+    path = BGPVIEW_PATH.format(ip=normalized_ip)
     try:
-        with request.urlopen(url, timeout=timeout_sec) as response:
-            payload = json.loads(response.read().decode("utf-8"))
-    except (URLError, TimeoutError, json.JSONDecodeError) as exc:
+        status, body = _BGPVIEW_POOL.get(path, timeout_sec)
+    except (OSError, http.client.HTTPException) as exc:
+        raise UpstreamLookupError("Unable to reach fallback ASN service") from exc
+    if status != 200:
+        raise UpstreamLookupError("Unable to reach fallback ASN service")
+
+    try:
+        payload = _json_loads(body)
+    except json.JSONDecodeError as exc:
         raise UpstreamLookupError("Unable to reach fallback ASN service") from exc
 
     data = payload.get("data", {})
@@ -124,8 +335,66 @@ def _lookup_bgpview(normalized_ip: str, timeout_sec: float) -> ASNResult:
 
 def lookup_asn(ip: str, timeout_sec: float = 4.0) -> ASNResult:
     normalized_ip = _validate_ip(ip)
+    cached = _RESULT_CACHE.get(normalized_ip)
+    if cached is not None:
+        return cached
 
     try:
-        return _lookup_team_cymru(normalized_ip, timeout_sec)
+        result = _lookup_team_cymru(normalized_ip, timeout_sec)
     except UpstreamLookupError:
-        return _lookup_bgpview(normalized_ip, timeout_sec)
+        result = _lookup_bgpview(normalized_ip, timeout_sec)
+
+    _RESULT_CACHE.set(normalized_ip, result)
+    return result
+
+
+def lookup_asn_batch(
+    ips: list[str], timeout_sec: float = 4.0
+) -> list[ASNResult | InvalidIPError | UpstreamLookupError]:
+    normalized: list[str | InvalidIPError] = []
+    for ip in ips:
+        try:
+            normalized.append(_validate_ip(ip))
+        except InvalidIPError as exc:
+            normalized.append(exc)
+
+    results: dict[str, ASNResult] = {}
+    misses: list[str] = []
+    for item in dict.fromkeys(n for n in normalized if isinstance(n, str)):
+        cached = _RESULT_CACHE.get(item)
+        if cached is not None:
+            results[item] = cached
+        else:
+            misses.append(item)
+
+    errors: dict[str, UpstreamLookupError] = {}
+    if misses:
+        try:
+            fetched = _lookup_team_cymru_bulk(misses, timeout_sec)
+        except UpstreamLookupError:
+            fetched = {}
+
+        futures = {
+            item: _FALLBACK_POOL.submit(_lookup_bgpview, item, timeout_sec)
+            for item in misses
+            if item not in fetched
+        }
+        for item, future in futures.items():
+            try:
+                fetched[item] = future.result()
+            except UpstreamLookupError as exc:
+                errors[item] = exc
+
+        for item, result in fetched.items():
+            _RESULT_CACHE.set(item, result)
+        results.update(fetched)
+
+    outcomes: list[ASNResult | InvalidIPError | UpstreamLookupError] = []
+    for item in normalized:
+        if isinstance(item, InvalidIPError):
+            outcomes.append(item)
+        elif item in results:
+            outcomes.append(results[item])
+        else:
+            outcomes.append(errors[item])
+    return outcomes
@@ -1,47 +1,97 @@
 from __future__ import annotations
 
 import json
+import math
 import os
 import threading
 import time
-from collections import defaultdict, deque
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs, urlparse
 
-from app.asn_lookup import InvalidIPError, UpstreamLookupError, lookup_asn
+from app.asn_lookup import (
+    ASNResult,
+    InvalidIPError,
+    UpstreamLookupError,
+    _json_dumps,
+    _json_loads,
+    lookup_asn,
+    lookup_asn_batch,
+)
+
+
+RATE_LIMIT_SHARDS = 16
+
+
+@dataclass(frozen=True, slots=True)
+class BatchItem:
+    ip: str
+    result: ASNResult | None
+    error: str | None
+
+
+_HEALTH_BODY = _json_dumps({"status": "ok"})
+_NOT_FOUND_BODY = _json_dumps({"error": "not found"})
+_RATE_LIMIT_BODY = _json_dumps({"error": "rate limit exceeded"})
+_BUSY_BODY = _json_dumps({"error": "server busy"})
+_BUSY_RESPONSE = (
+    "HTTP/1.1 503 Service Unavailable\r\n"
+    "Content-Type: application/json; charset=utf-8\r\n"
+    f"Content-Length: {len(_BUSY_BODY)}\r\n"
+    "Retry-After: 1\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+).encode("latin-1") + _BUSY_BODY
 
 
 class RateLimiter:
     def __init__(self, max_requests: int, window_sec: int) -> None:
         self.max_requests = max_requests
         self.window_sec = window_sec
-        self._hits: dict[str, deque[float]] = defaultdict(deque)
-        self._lock = threading.Lock()
+        # Each shard maps key -> (window index, hits in that window, hits in
+        # the window before) under its own lock.
+        self._shards: list[tuple[threading.Lock, dict[str, tuple[int, int, int]]]] = [
+            (threading.Lock(), {}) for _ in range(RATE_LIMIT_SHARDS)
+        ]
 
     def check(self, key: str, now: float | None = None) -> tuple[bool, int]:
         if self.max_requests <= 0 or self.window_sec <= 0:
             return True, -1
 
         current = now if now is not None else time.time()
-        window_start = current - self.window_sec
-
-        with self._lock:
-            bucket = self._hits[key]
-            while bucket and bucket[0] <= window_start:
-                bucket.popleft()
-
-            if len(bucket) >= self.max_requests:
-                retry_after = max(1, int(bucket[0] + self.window_sec - current))
-                return False, retry_after
-
-            bucket.append(current)
+        window = int(current // self.window_sec)
+        elapsed = current - window * self.window_sec
+
+        lock, hits = self._shards[hash(key) & (RATE_LIMIT_SHARDS - 1)]
+        with lock:
+            window_id, count, previous = hits.get(key, (window, 0, 0))
+            if window_id != window:
+                previous = count if window_id == window - 1 else 0
+                count = 0
+
+            weighted = previous * (1 - elapsed / self.window_sec) + count
+            if weighted >= self.max_requests:
+                hits[key] = (window, count, previous)
+                return False, self._retry_after(count, previous, elapsed)
+
+            hits[key] = (window, count + 1, previous)
             return True, -1
 
+    def _retry_after(self, count: int, previous: int, elapsed: float) -> int:
+        if count < self.max_requests:
+            # The previous window's share decays enough later in this window.
+            wait = self.window_sec * (1 - (self.max_requests - count) / previous) - elapsed
+        else:
+            # This window's hits become the previous window's share.
+            wait = (self.window_sec - elapsed) + self.window_sec * (
+                1 - self.max_requests / count
+            )
+        return max(1, math.floor(wait) + 1)
+
 
-def _single_lookup(ip: str) -> tuple[int, dict]:
+def _single_lookup(ip: str) -> tuple[int, ASNResult | dict]:
     try:
-        result = lookup_asn(ip)
-        return 200, result.__dict__
+        return 200, lookup_asn(ip)
     except InvalidIPError as exc:
         return 400, {"error": str(exc)}
     except UpstreamLookupError as exc:
@@ -52,31 +102,44 @@ def _batch_lookup(ips: list[str]) -> tuple[int, dict]:
     if not ips or len(ips) > 100:
         return 400, {"error": "ips must contain between 1 and 100 entries"}
 
-    items: list[dict] = []
-    for ip in ips:
-        status, payload = _single_lookup(ip)
-        if status == 200:
-            items.append({"ip": ip, "result": payload, "error": None})
+    items: list[BatchItem] = []
+    for ip, outcome in zip(ips, lookup_asn_batch(ips)):
+        if isinstance(outcome, ASNResult):
+            items.append(BatchItem(ip=ip, result=outcome, error=None))
         else:
-            items.append({"ip": ip, "result": None, "error": payload["error"]})
+            items.append(BatchItem(ip=ip, result=None, error=str(outcome)))
     return 200, {"items": items}
 
 
 class ASNLookupHandler(BaseHTTPRequestHandler):
     server_version = "ASNLookupHTTP/1.0"
-
-    def _send_json(self, status: int, payload: dict) -> None:
-        body = json.dumps(payload).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are dropped after this many seconds so they
+    # do not hold a worker thread indefinitely.
+    timeout = 15
+
+    def _send_body(self, status: int, body: bytes, extra_headers: str = "") -> None:
+        # Status line, headers and body go out in a single write instead of
+        # the separate header flush and body write of send_response().
+        self.log_request(status)
+        connection = "Connection: close\r\n" if self.close_connection else ""
+        head = (
+            f"{self.protocol_version} {status} {self.responses[status][0]}\r\n"
+            f"Server: {self.version_string()}\r\n"
+            f"Date: {self.date_time_string()}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"{extra_headers}{connection}\r\n"
+        )
+        self.wfile.write(head.encode("latin-1") + body)
+
+    def _send_json(self, status: int, payload: object) -> None:
+        self._send_body(status, _json_dumps(payload))
 
     def _client_key(self) -> str:
         forwarded_for = self.headers.get("X-Forwarded-For")
         if forwarded_for:
-            return forwarded_for.split(",")[0].strip()
+            return forwarded_for.partition(",")[0].strip()
         return self.client_address[0]
 
     def _enforce_rate_limit(self) -> bool:
@@ -85,21 +148,18 @@ class ASNLookupHandler(BaseHTTPRequestHandler):
         if allowed:
             return True
 
-        payload = json.dumps({"error": "rate limit exceeded"}).encode("utf-8")
-        self.send_response(429)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Retry-After", str(retry_after))
-        self.send_header("Content-Length", str(len(payload)))
-        self.end_headers()
-        self.wfile.write(payload)
+        self._send_body(429, _RATE_LIMIT_BODY, f"Retry-After: {retry_after}\r\n")
         return False
 
     def do_GET(self) -> None:  # noqa: N802
+        # GET bodies are never read, so the connection cannot be reused.
+        if "Transfer-Encoding" in self.headers or self.headers.get("Content-Length", "0") != "0":
+            self.close_connection = True
         if not self._enforce_rate_limit():
             return
         parsed = urlparse(self.path)
         if parsed.path == "/health":
-            self._send_json(200, {"status": "ok"})
+            self._send_body(200, _HEALTH_BODY)
             return
 
         if parsed.path == "/v1/asn/lookup":
@@ -112,22 +172,28 @@ class ASNLookupHandler(BaseHTTPRequestHandler):
             self._send_json(status, payload)
             return
 
-        self._send_json(404, {"error": "not found"})
+        self._send_body(404, _NOT_FOUND_BODY)
 
     def do_POST(self) -> None:  # noqa: N802
+        # Until the body is read, an early response must close the connection
+        # so the unread body is not parsed as the next request. Chunked bodies
+        # are never read, so those connections are always closed.
+        keep_alive = not self.close_connection and "Transfer-Encoding" not in self.headers
+        self.close_connection = True
         if not self._enforce_rate_limit():
             return
         parsed = urlparse(self.path)
         if parsed.path != "/v1/asn/lookup-batch":
-            self._send_json(404, {"error": "not found"})
+            self._send_body(404, _NOT_FOUND_BODY)
             return
 
         content_length = int(self.headers.get("Content-Length", "0"))
         raw = self.rfile.read(content_length) if content_length > 0 else b""
+        self.close_connection = not keep_alive
 
         try:
-            payload = json.loads(raw.decode("utf-8")) if raw else {}
-        except json.JSONDecodeError:
+            payload = _json_loads(raw) if raw else {}
+        except (json.JSONDecodeError, UnicodeDecodeError):
             self._send_json(400, {"error": "invalid JSON body"})
             return
 
@@ -140,12 +206,49 @@ class ASNLookupHandler(BaseHTTPRequestHandler):
         self._send_json(status, body)
 
 
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        server_address: tuple[str, int],
+        handler_class: type[BaseHTTPRequestHandler],
+        max_workers: int,
+    ) -> None:
+        super().__init__(server_address, handler_class)
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def process_request(self, request, client_address) -> None:
+        # Keep-alive connections hold their thread until they go idle, so
+        # connections beyond max_workers are refused instead of left waiting.
+        if not self._slots.acquire(blocking=False):
+            try:
+                request.sendall(_BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+
 def run() -> None:
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
     rate_limit_requests = int(os.getenv("RATE_LIMIT_REQUESTS", "60"))
     rate_limit_window_sec = int(os.getenv("RATE_LIMIT_WINDOW_SEC", "60"))
-    server = HTTPServer((host, port), ASNLookupHandler)
+    max_workers = int(os.getenv("HTTP_MAX_WORKERS", "64"))
+    server = BoundedThreadingHTTPServer((host, port), ASNLookupHandler, max_workers=max_workers)
     server.rate_limiter = RateLimiter(
         max_requests=rate_limit_requests,
         window_sec=rate_limit_window_sec,
@@ -156,7 +259,13 @@ def run() -> None:
         f"{rate_limit_requests} requests / {rate_limit_window_sec}s per IP "
         "(set RATE_LIMIT_REQUESTS=0 to disable)"
     )
-    server.serve_forever()
+    print(f"Worker threads: {max_workers} (set HTTP_MAX_WORKERS to change)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 if __name__ == "__main__":
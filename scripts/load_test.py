@@ -2,35 +2,59 @@
 from __future__ import annotations
 
 import argparse
+import http.client
 import json
+import statistics
 import threading
 import time
-import urllib.error
-import urllib.request
 from collections import Counter
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 
 
-def make_url(base_url: str, ip: str) -> str:
-    return f"{base_url.rstrip('/')}/v1/asn/lookup?ip={ip}"
+def make_path(ip: str) -> str:
+    return f"/v1/asn/lookup?ip={ip}"
 
 
-def one_request(url: str, timeout_sec: float) -> tuple[int, float]:
+_local = threading.local()
+
+
+def _connection(base_url: str, timeout_sec: float) -> http.client.HTTPConnection:
+    # One keep-alive connection per worker thread, reused across requests.
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        parsed = urlsplit(base_url)
+        conn_cls = (
+            http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        )
+        conn = conn_cls(parsed.hostname, parsed.port, timeout=timeout_sec)
+        _local.conn = conn
+    return conn
+
+
+def one_request(base_url: str, path: str, timeout_sec: float) -> tuple[int, float]:
     started = time.perf_counter()
-    req = urllib.request.Request(url, method="GET")
+    conn = _connection(base_url, timeout_sec)
     try:
-        with urllib.request.urlopen(req, timeout=timeout_sec) as resp:
-            status = resp.status
-            _ = resp.read()
-    except urllib.error.HTTPError as exc:
-        status = exc.code
-        _ = exc.read()
-    except urllib.error.URLError:
+        conn.request("GET", path, headers={"Connection": "keep-alive"})
+        resp = conn.getresponse()
+        status = resp.status
+        _ = resp.read()
+    except (OSError, http.client.HTTPException):
+        conn.close()
         status = 0
     elapsed_ms = (time.perf_counter() - started) * 1000
     return status, elapsed_ms
 
 
+def latency_percentiles(latencies_ms: list[float]) -> tuple[float, float, float]:
+    if len(latencies_ms) < 2:
+        value = latencies_ms[0] if latencies_ms else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(latencies_ms, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Simple load test for ASN Lookup API")
     parser.add_argument("--base-url", default="http://127.0.0.1:8000")
@@ -46,26 +70,25 @@ def main() -> None:
     args = parse_args()
     total = max(1, args.requests)
     concurrency = max(1, min(args.concurrency, total))
-    url = make_url(args.base_url, args.ip)
-
-    lock = threading.Lock()
-    status_counts: Counter[int] = Counter()
-    latencies_ms: list[float] = []
+    path = urlsplit(args.base_url).path.rstrip("/") + make_path(args.ip)
+    url = f"{args.base_url.rstrip('/')}{make_path(args.ip)}"
 
     started = time.perf_counter()
     with ThreadPoolExecutor(max_workers=concurrency) as pool:
-        futures = [pool.submit(one_request, url, args.timeout_sec) for _ in range(total)]
-        for future in as_completed(futures):
-            status, latency_ms = future.result()
-            with lock:
-                status_counts[status] += 1
-                latencies_ms.append(latency_ms)
+        futures = [
+            pool.submit(one_request, args.base_url, path, args.timeout_sec) for _ in range(total)
+        ]
+        results = [future.result() for future in as_completed(futures)]
     total_elapsed = time.perf_counter() - started
 
+    status_counts: Counter[int] = Counter(status for status, _ in results)
+    latencies_ms = [latency_ms for _, latency_ms in results]
+
     success = status_counts.get(200, 0)
     rate_limited = status_counts.get(429, 0)
     failures = total - success - rate_limited
     avg_latency = sum(latencies_ms) / len(latencies_ms) if latencies_ms else 0.0
+    p50, p95, p99 = latency_percentiles(latencies_ms)
 
     summary = {
         "base_url": args.base_url,
@@ -76,6 +99,9 @@ def main() -> None:
         "duration_sec": round(total_elapsed, 3),
         "rps": round(total / total_elapsed, 2) if total_elapsed > 0 else 0.0,
         "avg_latency_ms": round(avg_latency, 2),
+        "p50_latency_ms": round(p50, 2),
+        "p95_latency_ms": round(p95, 2),
+        "p99_latency_ms": round(p99, 2),
         "status_counts": dict(sorted(status_counts.items())),
         "success_200": success,
         "rate_limited_429": rate_limited,
@@ -93,6 +119,11 @@ def main() -> None:
     print(f"- Duration: {summary['duration_sec']}s")
     print(f"- Throughput: {summary['rps']} req/s")
     print(f"- Avg latency: {summary['avg_latency_ms']} ms")
+    print(
+        "- Latency p50/p95/p99: "
+        f"{summary['p50_latency_ms']} / {summary['p95_latency_ms']} / "
+        f"{summary['p99_latency_ms']} ms"
+    )
     print(f"- Status counts: {summary['status_counts']}")
     print(f"- 200 OK: {success}")
     print(f"- 429 Rate Limited: {rate_limited}")
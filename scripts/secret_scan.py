@@ -3,10 +3,12 @@
 
 from __future__ import annotations
 
+import mmap
+import os
 import re
 import subprocess
 import sys
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 
 PATTERNS = [
@@ -17,11 +19,23 @@ PATTERNS = [
     (
         "generic-secret-assignment",
         re.compile(
-            r"(?i)\b(password|passwd|pwd|token|api[_-]?key|secret)\b\s*[:=]\s*['\"][^'\"]{8,}['\"]"
+            r"(?i:\b(password|passwd|pwd|token|api[_-]?key|secret)\b[^\S\n]*[:=][^\S\n]*['\"][^'\"\n]{8,}['\"])"
         ),
     ),
 ]
 
+# Byte-level prefilter: every match of a rule above contains a match of this
+# pattern, so one search over the raw file finds the lines worth decoding.
+# Those lines are then checked rule by rule, exactly like a per-line scan.
+# Whitespace also allows control and non-ASCII bytes because the str rules
+# accept Unicode whitespace.
+CANDIDATE_PATTERN = re.compile(
+    rb"-----BEGIN |gh[pousr]_|A3T|AKIA|ASIA|xox[baprs]-"
+    rb"|(?i:password|passwd|pwd|token|api[_-]?key|secret)(?:\s|[\x1c-\x1f\x80-\xff])*[:=]"
+)
+# The UTF-8 encodings of the separators str.splitlines() breaks on.
+LINE_BREAK = re.compile(rb"\r\n|[\n\r\x0b\x0c\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]")
+
 SKIP_EXTENSIONS = {
     ".png",
     ".jpg",
@@ -56,20 +70,22 @@ SAFE_HINTS = (
 
 ALLOW_MARKER = "allow-secret"
 
+# Same heuristic as git: a NUL byte in the first 8 KiB marks a binary file.
+TEXT_PROBE_BYTES = 8192
+
 
-def git_ls_files() -> list[Path]:
-    result = subprocess.run(
-        ["git", "ls-files"], capture_output=True, text=True, check=True
-    )
-    return [Path(line.strip()) for line in result.stdout.splitlines() if line.strip()]
+def git_ls_files() -> list[str]:
+    result = subprocess.run(["git", "ls-files", "-z"], capture_output=True, check=True)
+    return [path for path in os.fsdecode(result.stdout).split("\0") if path]
 
 
-def is_probably_text(path: Path) -> bool:
+def is_probably_text(path: str) -> bool:
     try:
-        raw = path.read_bytes()
+        with open(path, "rb") as handle:
+            head = handle.read(TEXT_PROBE_BYTES)
     except OSError:
         return False
-    return b"\x00" not in raw
+    return b"\x00" not in head
 
 
 def should_skip_line(line: str) -> bool:
@@ -79,26 +95,60 @@ def should_skip_line(line: str) -> bool:
     return any(hint in lower for hint in SAFE_HINTS)
 
 
+def scan_file(path: str) -> list[tuple[str, int, str, str]]:
+    if os.path.splitext(path)[1].lower() in SKIP_EXTENSIONS or not is_probably_text(path):
+        return []
+
+    try:
+        with open(path, "rb") as handle, mmap.mmap(
+            handle.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            return _scan_buffer(path, data)
+    except (OSError, ValueError):
+        # ValueError: empty files cannot be mapped.
+        return []
+
+
+def _scan_buffer(path: str, data: mmap.mmap) -> list[tuple[str, int, str, str]]:
+    findings: list[tuple[str, int, str, str]] = []
+    line_no = 1
+    line_start = 0
+    while True:
+        candidate = CANDIDATE_PATTERN.search(data, line_start)
+        if candidate is None:
+            break
+
+        # Walk forward to the line holding the candidate.
+        while True:
+            line_break = LINE_BREAK.search(data, line_start)
+            if line_break is None:
+                line_end = next_start = len(data)
+                break
+            if line_break.start() >= candidate.start():
+                line_end, next_start = line_break.start(), line_break.end()
+                break
+            line_start = line_break.end()
+            line_no += 1
+
+        line = data[line_start:line_end].decode("utf-8", errors="ignore")
+        rule = next((name for name, pattern in PATTERNS if pattern.search(line)), None)
+        if rule is not None and not should_skip_line(line):
+            findings.append((path, line_no, rule, line.strip()))
+
+        if next_start >= len(data):
+            break
+        line_start = next_start
+        line_no += 1
+    return findings
+
+
 def main() -> int:
     findings: list[tuple[str, int, str, str]] = []
-    for rel_path in git_ls_files():
-        if rel_path.suffix.lower() in SKIP_EXTENSIONS:
-            continue
-        if not rel_path.exists() or not is_probably_text(rel_path):
-            continue
-
-        try:
-            lines = rel_path.read_text(encoding="utf-8", errors="ignore").splitlines()
-        except OSError:
-            continue
-
-        for idx, line in enumerate(lines, start=1):
-            if should_skip_line(line):
-                continue
-            for rule_name, pattern in PATTERNS:
-                if pattern.search(line):
-                    findings.append((str(rel_path), idx, rule_name, line.strip()))
-                    break
+    # Files are independent, so their reads overlap across threads; map()
+    # keeps the report in git ls-files order.
+    with ThreadPoolExecutor() as pool:
+        for file_findings in pool.map(scan_file, git_ls_files()):
+            findings.extend(file_findings)
 
     if findings:
         print("Secret scan failed. Potential sensitive values found:")
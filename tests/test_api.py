@@ -1,8 +1,23 @@
+import http.client
+import json
+import socket
+import threading
+import time
 import unittest
+from http.server import ThreadingHTTPServer
 from unittest.mock import patch
 
 from app.asn_lookup import ASNResult
-from app.main import RateLimiter, _batch_lookup, _single_lookup
+from app.main import (
+    ASNLookupHandler,
+    BoundedThreadingHTTPServer,
+    BatchItem,
+    RateLimiter,
+    _BUSY_BODY,
+    _batch_lookup,
+    _json_dumps,
+    _single_lookup,
+)
 
 
 class TestASNAPI(unittest.TestCase):
@@ -21,6 +36,16 @@ class TestASNAPI(unittest.TestCase):
         self.assertFalse(allowed)
         self.assertEqual(limiter.check("127.0.0.1", now=1006.0), (True, -1))
 
+    def test_rate_limiter_weights_previous_window(self) -> None:
+        limiter = RateLimiter(max_requests=2, window_sec=10)
+        self.assertEqual(limiter.check("127.0.0.1", now=1005.0), (True, -1))
+        self.assertEqual(limiter.check("127.0.0.1", now=1006.0), (True, -1))
+        self.assertEqual(limiter.check("127.0.0.1", now=1012.0), (True, -1))
+        allowed, retry_after = limiter.check("127.0.0.1", now=1013.0)
+        self.assertFalse(allowed)
+        self.assertEqual(retry_after, 3)
+        self.assertEqual(limiter.check("127.0.0.1", now=1016.0), (True, -1))
+
     def test_rate_limiter_can_be_disabled(self) -> None:
         limiter = RateLimiter(max_requests=0, window_sec=60)
         for _ in range(5):
@@ -39,7 +64,7 @@ class TestASNAPI(unittest.TestCase):
         )
         status, payload = _single_lookup("8.8.8.8")
         self.assertEqual(status, 200)
-        self.assertEqual(payload["asn"], 15169)
+        self.assertEqual(payload.asn, 15169)
 
     @patch("app.main.lookup_asn")
     def test_lookup_invalid_ip(self, mock_lookup) -> None:
@@ -59,28 +84,67 @@ class TestASNAPI(unittest.TestCase):
         self.assertEqual(status, 502)
         self.assertIn("Unable to reach upstream ASN service", payload["error"])
 
-    @patch("app.main.lookup_asn")
-    def test_batch_partial_success(self, mock_lookup) -> None:
+    @patch("app.main.lookup_asn_batch")
+    def test_batch_partial_success(self, mock_lookup_batch) -> None:
         from app.asn_lookup import InvalidIPError
 
-        def side_effect(ip: str, timeout_sec: float = 4.0):
-            if ip == "bad":
-                raise InvalidIPError("Invalid IP: bad")
-            return ASNResult(
-                ip=ip,
-                asn=13335,
-                bgp_prefix="1.1.1.0/24",
-                country_code="US",
-                registry="apnic",
-                allocated_date="2011-08-11",
-                as_name="CLOUDFLARENET, US",
-            )
-
-        mock_lookup.side_effect = side_effect
+        def side_effect(ips: list[str], timeout_sec: float = 4.0):
+            outcomes = []
+            for ip in ips:
+                if ip == "bad":
+                    outcomes.append(InvalidIPError("Invalid IP: bad"))
+                    continue
+                outcomes.append(
+                    ASNResult(
+                        ip=ip,
+                        asn=13335,
+                        bgp_prefix="1.1.1.0/24",
+                        country_code="US",
+                        registry="apnic",
+                        allocated_date="2011-08-11",
+                        as_name="CLOUDFLARENET, US",
+                    )
+                )
+            return outcomes
+
+        mock_lookup_batch.side_effect = side_effect
         status, payload = _batch_lookup(["1.1.1.1", "bad"])
         self.assertEqual(status, 200)
-        self.assertEqual(payload["items"][0]["result"]["asn"], 13335)
-        self.assertEqual(payload["items"][1]["error"], "Invalid IP: bad")
+        self.assertEqual(payload["items"][0].result.asn, 13335)
+        self.assertEqual(payload["items"][1].error, "Invalid IP: bad")
+
+    def test_json_dumps_encodes_batch_items(self) -> None:
+        result = ASNResult(
+            ip="1.1.1.1",
+            asn=13335,
+            bgp_prefix="1.1.1.0/24",
+            country_code="US",
+            registry="apnic",
+            allocated_date="2011-08-11",
+            as_name="CLOUDFLARENET, US",
+        )
+        payload = {"items": [BatchItem(ip="1.1.1.1", result=result, error=None)]}
+        expected = {
+            "items": [
+                {
+                    "ip": "1.1.1.1",
+                    "result": {
+                        "ip": "1.1.1.1",
+                        "asn": 13335,
+                        "bgp_prefix": "1.1.1.0/24",
+                        "country_code": "US",
+                        "registry": "apnic",
+                        "allocated_date": "2011-08-11",
+                        "as_name": "CLOUDFLARENET, US",
+                        "source": "team-cymru-whois",
+                    },
+                    "error": None,
+                }
+            ]
+        }
+        self.assertEqual(json.loads(_json_dumps(payload)), expected)
+        with patch("app.asn_lookup.orjson", None):
+            self.assertEqual(json.loads(_json_dumps(payload)), expected)
 
     def test_batch_size_validation(self) -> None:
         status, payload = _batch_lookup([])
@@ -88,5 +152,131 @@ class TestASNAPI(unittest.TestCase):
         self.assertIn("between 1 and 100", payload["error"])
 
 
+class _QuietHandler(ASNLookupHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class TestASNLookupHandler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _QuietHandler)
+        cls.server.rate_limiter = RateLimiter(max_requests=1, window_sec=60)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _raw_exchange(self, request: bytes) -> bytes:
+        # Reads until the server closes the connection, so this only returns
+        # for responses that end the connection.
+        with socket.create_connection(self.server.server_address, timeout=5) as sock:
+            sock.sendall(request)
+            chunks = []
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                chunks.append(data)
+        return b"".join(chunks)
+
+    def test_response_has_status_line_and_content_length(self) -> None:
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=5)
+        self.addCleanup(conn.close)
+        conn.request("GET", "/health", headers={"X-Forwarded-For": "203.0.113.1"})
+        response = conn.getresponse()
+        body = response.read()
+
+        self.assertEqual(response.version, 11)
+        self.assertEqual((response.status, response.reason), (200, "OK"))
+        self.assertEqual(body, _json_dumps({"status": "ok"}))
+        self.assertEqual(response.getheader("Content-Length"), str(len(body)))
+        self.assertEqual(response.getheader("Content-Type"), "application/json; charset=utf-8")
+        self.assertIsNone(response.getheader("Connection"))
+
+    def test_rate_limited_response_has_retry_after(self) -> None:
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=5)
+        self.addCleanup(conn.close)
+        headers = {"X-Forwarded-For": "203.0.113.2"}
+        conn.request("GET", "/health", headers=headers)
+        conn.getresponse().read()
+        conn.request("GET", "/health", headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+
+        self.assertEqual((response.status, response.reason), (429, "Too Many Requests"))
+        self.assertEqual(body, _json_dumps({"error": "rate limit exceeded"}))
+        self.assertGreaterEqual(int(response.getheader("Retry-After")), 1)
+
+    def test_early_post_reply_closes_connection(self) -> None:
+        body = b'{"ips": ["8.8.8.8"]}'
+        raw = self._raw_exchange(
+            b"POST /missing HTTP/1.1\r\n"
+            b"Host: test\r\n"
+            b"X-Forwarded-For: 203.0.113.3\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+
+        head, _, payload = raw.partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 404 Not Found\r\n"))
+        self.assertIn(b"\r\nConnection: close", head)
+        self.assertIn(b"\r\nContent-Length: " + str(len(payload)).encode(), head)
+        self.assertEqual(payload, _json_dumps({"error": "not found"}))
+
+    def test_chunked_post_closes_connection(self) -> None:
+        raw = self._raw_exchange(
+            b"POST /v1/asn/lookup-batch HTTP/1.1\r\n"
+            b"Host: test\r\n"
+            b"X-Forwarded-For: 203.0.113.4\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+            b"13\r\n{\"ips\": [\"8.8.8.8\"]}\r\n0\r\n\r\n"
+        )
+
+        self.assertEqual(raw.count(b"HTTP/1.1 "), 1)
+        self.assertTrue(raw.startswith(b"HTTP/1.1 400 Bad Request\r\n"))
+        self.assertIn(b"\r\nConnection: close", raw)
+
+
+class TestBoundedThreadingHTTPServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = BoundedThreadingHTTPServer(("127.0.0.1", 0), _QuietHandler, max_workers=1)
+        self.server.rate_limiter = RateLimiter(max_requests=0, window_sec=60)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_refuses_connections_beyond_limit(self) -> None:
+        held = http.client.HTTPConnection(*self.server.server_address, timeout=5)
+        self.addCleanup(held.close)
+        held.request("GET", "/health")
+        held.getresponse().read()
+
+        with socket.create_connection(self.server.server_address, timeout=5) as sock:
+            raw = sock.makefile("rb").read()
+        self.assertTrue(raw.startswith(b"HTTP/1.1 503 Service Unavailable\r\n"))
+        self.assertIn(b"\r\nRetry-After: 1\r\n", raw)
+        self.assertTrue(raw.endswith(_BUSY_BODY))
+
+        # The slot is released once the server notices the client closed.
+        held.close()
+        raw = b""
+        for _ in range(50):
+            try:
+                with socket.create_connection(self.server.server_address, timeout=5) as sock:
+                    sock.sendall(b"GET /health HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n")
+                    raw = sock.makefile("rb").read()
+            except OSError:
+                raw = b""
+            if raw.startswith(b"HTTP/1.1 200"):
+                break
+            time.sleep(0.02)
+        self.assertTrue(raw.startswith(b"HTTP/1.1 200 OK\r\n"))
+
+
 if __name__ == "__main__":
     unittest.main()